@@ -74,7 +74,7 @@ class Chain(Link):
         """
         self._map_arguments(self.args)
         self.files.latch_file_info(self.args)
-        self.sub_files.file_dict.clear()
+        self.sub_files.clear()
         self.sub_files.update(self.files.file_dict)
         for link in self._links.values():
             self.sub_files.update(link.files.file_dict)
@@ -14,31 +14,122 @@ import time
 import tempfile
 from shutil import copyfile
 
-from collections import OrderedDict
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 import numpy as np
 # from numpy.core import defchararray
-from astropy.table import Table, Column
+from astropy.table import Table
 
 from fermipy.fits_utils import write_tables_to_fits
 
+try:
+    import h5py
+    HAVE_H5PY = True
+except ImportError:
+    HAVE_H5PY = False
+
+# Names of the columns used to persist `FileHandle` objects
+FILE_COLNAMES = ['key', 'path', 'creator', 'timestamp', 'status', 'flags']
+
+# Columns that can change after a file is registered
+FILE_MUTABLE_COLNAMES = ['creator', 'timestamp', 'status', 'flags']
+
+# File extensions for which the `FileArchive` is persisted as HDF5
+HDF5_EXTENSIONS = ['.h5', '.hdf5']
+
+# Rough number of bytes per entry in the size of a directory
+SCANDIR_DIRENT_NBYTES = 32
+
+# Fraction of the entries of a directory that must be looked up
+# for `get_file_timestamps` to list it rather than stat each file
+SCANDIR_MIN_FRACTION = 0.25
+
+# Size of the HDF5 chunk cache used when reading and writing archives
+HDF5_CACHE_NBYTES = 128 * 1024 * 1024
+HDF5_CACHE_NSLOTS = 1000003
+
 
 def get_timestamp():
     """Get the current time as an integer"""
     return int(time.time())
 
 
+def get_file_timestamps(fullpaths):
+    """Get the modification times of a set of files as integers.
+
+    The files are grouped by directory.  A directory is listed once
+    with `os.scandir` only if the files asked for in it are a sizable
+    fraction of its entries, as estimated from the size of the
+    directory itself (see `SCANDIR_MIN_FRACTION`), so that files that
+    do not exist cost no system call.  Otherwise, or if `os.scandir`
+    is not available or the directory can not be listed, the files are
+    checked one by one with `os.stat`.
+
+    Returns a dict mapping the path of each file that exists to its
+    modification time.
+    """
+    dir_dict = {}
+    for fullpath in fullpaths:
+        dirname, basename = os.path.split(fullpath)
+        dir_dict.setdefault(dirname, {})[basename] = fullpath
+    ret_dict = {}
+    for dirname, file_dict in dir_dict.items():
+        entries = _scan_directory(dirname or os.curdir, len(file_dict))
+        if entries is None:
+            for fullpath in file_dict.values():
+                try:
+                    ret_dict[fullpath] = int(os.stat(fullpath).st_mtime)
+                except OSError:
+                    pass
+            continue
+        for entry in entries:
+            fullpath = file_dict.get(entry.name)
+            if fullpath is None:
+                continue
+            try:
+                ret_dict[fullpath] = int(entry.stat().st_mtime)
+            except OSError:
+                pass
+    return ret_dict
+
+
+def _scan_directory(dirname, nfiles):
+    """Return the entries of a directory in which nfiles are looked up
+
+    This returns None if it is cheaper to stat the files one by one,
+    if `os.scandir` is not available or if the directory can not be
+    listed.
+    """
+    scandir = getattr(os, 'scandir', None)
+    if scandir is None:
+        return None
+    try:
+        nentries = os.stat(dirname).st_size // SCANDIR_DIRENT_NBYTES
+        if nfiles < SCANDIR_MIN_FRACTION * nentries:
+            return None
+        return list(scandir(dirname))
+    except OSError:
+        return None
+
+
 def get_unique_match(table, colname, value):
     """Get the row matching value for a particular column.
     If exactly one row matchs, return index of that row,
     Otherwise raise KeyError.
     """
+    col = table[colname]
     # FIXME, This is here for python 3.5, where astropy is now returning bytes
-    # instead of str
-    if table[colname].dtype.kind in ['S', 'U']:
-        mask = table[colname].astype(str) == value
+    # instead of str.  Compare against the encoded value rather than
+    # converting the whole column to str.
+    if col.dtype.kind == 'S' and isinstance(value, str):
+        mask = col == value.encode()
+    elif col.dtype.kind in ['S', 'U']:
+        mask = col.astype(str) == value
     else:
-        mask = table[colname] == value
+        mask = col == value
 
     if mask.sum() != 1:
         raise KeyError("%i rows in column %s match value %s" %
@@ -46,6 +137,17 @@ def get_unique_match(table, colname, value):
     return np.argmax(mask)
 
 
+def decode_column(column):
+    """Return the values of a string column as a `numpy` array of str.
+
+    Byte string columns are decoded in a single vectorized call.
+    """
+    data = np.asarray(column)
+    if data.dtype.kind == 'S':
+        return np.char.decode(data, 'utf-8')
+    return data.astype(str)
+
+
 # @unique
 # class FileStatus(Enum):
 class FileStatus(object):
@@ -88,44 +190,51 @@ class FileDict(object):
         Dictionary mapping file path to `FileFlags` enum
     """
 
+    __slots__ = ('file_args', 'file_dict')
+
     def __init__(self, **kwargs):
         """C'tor"""
         self.file_args = kwargs.get('file_args', {})
         self.file_dict = {}
 
+    def _select_files(self, mask, value):
+        """Return the list of files for which (flags & mask) == value"""
+        return [key for key, val in self.file_dict.items()
+                if val & mask == value]
+
+    def clear(self):
+        """Remove all the files from self.file_dict"""
+        self.file_dict.clear()
+
     def latch_file_info(self, args):
         """Extract the file paths from a set of arguments
         """
-        self.file_dict.clear()
+        self.clear()
+        fdict = self.file_dict
         for key, val in self.file_args.items():
-            try:
-                file_path = args[key]
-                if file_path is None:
-                    continue
-                # 'args' is special
-                if key[0:4] == 'args':
-                    if isinstance(file_path, list):
-                        tokens = file_path
-                    elif isinstance(file_path, str):
-                        tokens = file_path.split()
-                    else:
-                        raise TypeError(
-                            "Args has type %s, expect list or str" % type(file_path))
-                    for token in tokens:
-                        self.file_dict[token.replace('.gz', '')] = val
+            file_path = args.get(key)
+            if file_path is None:
+                continue
+            # 'args' is special
+            if key.startswith('args'):
+                if isinstance(file_path, list):
+                    tokens = file_path
+                elif isinstance(file_path, str):
+                    tokens = file_path.split()
                 else:
-                    self.file_dict[file_path.replace('.gz', '')] = val
-            except KeyError:
-                pass
+                    raise TypeError(
+                        "Args has type %s, expect list or str" % type(file_path))
+                for token in tokens:
+                    fdict[token[:-3] if token.endswith('.gz') else token] = val
+            else:
+                fdict[file_path[:-3] if file_path.endswith('.gz') else file_path] = val
 
     def update(self, file_dict):
         """Update self with values from a dictionary
         mapping file path [str] to `FileFlags` enum """
+        fdict = self.file_dict
         for key, val in file_dict.items():
-            if key in self.file_dict:
-                self.file_dict[key] |= val
-            else:
-                self.file_dict[key] = val
+            fdict[key] = fdict.get(key, 0) | val
 
     def items(self):
         """Return iterator over self.file_dict"""
@@ -141,12 +250,8 @@ class FileDict(object):
         That is to say this will include files produced by one
         `Link` in a `Chain` and used as input to another `Link` in the `Chain`
         """
-        ret_list = []
-        for key, val in self.file_dict.items():
-            # For input files we only want files that were marked as input
-            if val & FileFlags.input_mask:
-                ret_list.append(key)
-        return ret_list
+        # For input files we only want files that were marked as input
+        return self._select_files(FileFlags.input_mask, FileFlags.input_mask)
 
     @property
     def output_files(self):
@@ -158,12 +263,8 @@ class FileDict(object):
         That is to say this will include files produced by one
         `Link` in a `Chain` and used as input to another `Link` in the `Chain`
         """
-        ret_list = []
-        for key, val in self.file_dict.items():
-            # For output files we only want files that were marked as output
-            if val & FileFlags.output_mask:
-                ret_list.append(key)
-        return ret_list
+        # For output files we only want files that were marked as output
+        return self._select_files(FileFlags.output_mask, FileFlags.output_mask)
 
     @property
     def chain_input_files(self):
@@ -172,13 +273,9 @@ class FileDict(object):
         For `Link` sub-classes this will return only those files
         that were not created by any internal `Link`
         """
-        ret_list = []
-        for key, val in self.file_dict.items():
-            # For chain input files we only want files that were not marked as output
-            # (I.e., not produced by some other step in the chain)
-            if val & FileFlags.in_ch_mask == FileFlags.input_mask:
-                ret_list.append(key)
-        return ret_list
+        # For chain input files we only want files that were not marked as output
+        # (I.e., not produced by some other step in the chain)
+        return self._select_files(FileFlags.in_ch_mask, FileFlags.input_mask)
 
     @property
     def chain_output_files(self):
@@ -187,13 +284,9 @@ class FileDict(object):
         For `Link` sub-classes this will return only those files
         that were not marked as internal files or marked for removal.
         """
-        ret_list = []
-        for key, val in self.file_dict.items():
-            # For pure input files we only want output files that were not
-            # marked as internal or temp
-            if val & FileFlags.out_ch_mask == FileFlags.output_mask:
-                ret_list.append(key)
-        return ret_list
+        # For pure input files we only want output files that were not
+        # marked as internal or temp
+        return self._select_files(FileFlags.out_ch_mask, FileFlags.output_mask)
 
     @property
     def input_files_to_stage(self):
@@ -205,12 +298,8 @@ class FileDict(object):
         That is to say this will include files produced by one
         `Link` in a `Chain` and used as input to another `Link` in the `Chain`
         """
-        ret_list = []
-        for key, val in self.file_dict.items():
-            # For input files we only want files that were marked as input
-            if val & FileFlags.in_stage_mask == FileFlags.in_stage_mask:
-                ret_list.append(key)
-        return ret_list
+        # For input files we only want files that were marked as input
+        return self._select_files(FileFlags.in_stage_mask, FileFlags.in_stage_mask)
 
     @property
     def output_files_to_stage(self):
@@ -222,12 +311,8 @@ class FileDict(object):
         That is to say this will include files produced by one
         `Link` in a `Chain` and used as input to another `Link` in the `Chain`
         """
-        ret_list = []
-        for key, val in self.file_dict.items():
-            # For input files we only want files that were marked as input
-            if val & FileFlags.out_stage_mask == FileFlags.out_stage_mask:
-                ret_list.append(key)
-        return ret_list
+        # For input files we only want files that were marked as input
+        return self._select_files(FileFlags.out_stage_mask, FileFlags.out_stage_mask)
 
     @property
     def internal_files(self):
@@ -235,13 +320,9 @@ class FileDict(object):
 
         This returns all files that were explicitly marked as internal files.
         """
-        ret_list = []
-        for key, val in self.file_dict.items():
-            # For internal files we only want files that were marked as
-            # internal
-            if val & FileFlags.internal_mask:
-                ret_list.append(key)
-        return ret_list
+        # For internal files we only want files that were marked as
+        # internal
+        return self._select_files(FileFlags.internal_mask, FileFlags.internal_mask)
 
     @property
     def temp_files(self):
@@ -249,12 +330,8 @@ class FileDict(object):
 
         This returns all files that were explicitly marked for removal.
         """
-        ret_list = []
-        for key, val in self.file_dict.items():
-            # For temp files we only want files that were marked for removal
-            if val & FileFlags.rm_mask:
-                ret_list.append(key)
-        return ret_list
+        # For temp files we only want files that were marked for removal
+        return self._select_files(FileFlags.rm_mask, FileFlags.rm_mask)
 
     @property
     def gzip_files(self):
@@ -262,12 +339,8 @@ class FileDict(object):
 
         This returns all files that were explicitly marked for compression.
         """
-        ret_list = []
-        for key, val in self.file_dict.items():
-            # For temp files we only want files that were marked for removal
-            if val & FileFlags.gz_mask:
-                ret_list.append(key)
-        return ret_list
+        # For temp files we only want files that were marked for removal
+        return self._select_files(FileFlags.gz_mask, FileFlags.gz_mask)
 
     def print_summary(self, stream=sys.stdout, indent=""):
         """Print a summary of the files in this file dict.
@@ -438,6 +511,8 @@ class FileHandle(object):
         Path to file
     """
 
+    __slots__ = ('key', 'creator', 'timestamp', 'status', 'flags', 'path')
+
     def __init__(self, **kwargs):
         """C'tor
 
@@ -455,18 +530,23 @@ class FileHandle(object):
     @staticmethod
     def make_table(file_dict):
         """Build and return an `astropy.table.Table` to store `FileHandle`"""
-        col_key = Column(name='key', dtype=int)
-        col_path = Column(name='path', dtype='S256')
-        col_creator = Column(name='creator', dtype=int)
-        col_timestamp = Column(name='timestamp', dtype=int)
-        col_status = Column(name='status', dtype=int)
-        col_flags = Column(name='flags', dtype=int)
+        nfiles = len(file_dict)
+        col_key = np.empty((nfiles), dtype=int)
+        col_path = np.empty((nfiles), dtype='S256')
+        col_creator = np.empty((nfiles), dtype=int)
+        col_timestamp = np.empty((nfiles), dtype=int)
+        col_status = np.empty((nfiles), dtype=int)
+        col_flags = np.empty((nfiles), dtype=int)
+        for i, val in enumerate(file_dict.values()):
+            col_key[i] = val.key
+            col_path[i] = val.path.encode()
+            col_creator[i] = val.creator
+            col_timestamp[i] = val.timestamp
+            col_status[i] = val.status
+            col_flags[i] = val.flags
         columns = [col_key, col_path, col_creator,
                    col_timestamp, col_status, col_flags]
-        table = Table(data=columns)
-        for val in file_dict.values():
-            val.append_to_table(table)
-        return table
+        return Table(data=columns, names=FILE_COLNAMES)
 
     @classmethod
     def make_dict(cls, table):
@@ -475,17 +555,31 @@ class FileHandle(object):
         The dictionary is keyed by FileHandle.key, which is a unique integer for each file
         """
         ret_dict = {}
-        for row in table:
-            file_handle = cls.create_from_row(row)
-        ret_dict[file_handle.key] = file_handle
+        columns = [np.asarray(table['key']).tolist(),
+                   decode_column(table['path']).tolist(),
+                   np.asarray(table['creator']).tolist(),
+                   np.asarray(table['timestamp']).tolist(),
+                   np.asarray(table['status']).tolist(),
+                   np.asarray(table['flags']).tolist()]
+        for key, path, creator, timestamp, status, flags in zip(*columns):
+            ret_dict[key] = cls(key=key, path=path, creator=creator,
+                                timestamp=timestamp, status=status, flags=flags)
         return ret_dict
 
     @classmethod
     def create_from_row(cls, table_row):
-        """Build and return a `FileHandle` from an `astropy.table.row.Row` """
+        """Build and return a `FileHandle` from an `astropy.table.row.Row`
+
+        To build the `FileHandle` objects for all the rows of a table, use
+        `make_dict`, which converts each column only once.
+        """
         kwargs = {}
         for key in table_row.colnames:
-            kwargs[key] = table_row[key]
+            value = table_row[key]
+            # Some versions of astropy return bytes for string columns
+            if isinstance(value, bytes):
+                value = value.decode()
+            kwargs[key] = value
         try:
             return cls(**kwargs)
         except KeyError:
@@ -540,9 +634,43 @@ class FileHandle(object):
         table[row_idx]['flags'] = self.flags
 
 
+class FileHandleView(Mapping):
+    """Read-only mapping from local file path to `FileHandle`
+
+    This is backed by the path index of a `FileArchive`, so it reflects
+    later changes to the archive, and `FileHandle` objects are only
+    created as they are looked up.
+    """
+
+    __slots__ = ('_archive',)
+
+    def __init__(self, archive):
+        """C'tor, takes the `FileArchive` being viewed"""
+        self._archive = archive
+
+    def __getitem__(self, key):
+        """Return the `FileHandle` whose local path is key"""
+        return self._archive[key]
+
+    def __contains__(self, key):
+        """Return True if key is a local path in the archive"""
+        return key in self._archive.path_index
+
+    def __iter__(self):
+        """Iterate over the local paths in the archive"""
+        return iter(self._archive.path_index)
+
+    def __len__(self):
+        """Return the number of files in the archive"""
+        return len(self._archive.path_index)
+
+
 class FileArchive(object):
     """Class that keeps track of the status of files used in an analysis
 
+    The information about the files is held as one `numpy` array per
+    column, `FileHandle` objects are only built when they are requested.
+
     Parameters
     ----------
 
@@ -550,29 +678,49 @@ class FileArchive(object):
         Path to the file used to persist this `FileArchive`
     table        : `astropy.table.Table`
         Persistent representation of this `FileArchive`
-    cache        : `OrderedDict`
-        Transient representation of this `FileArchive`
+    cache        : `FileHandleView`
+        Read-only mapping from local file path to `FileHandle`
+    handles      : list
+        All the `FileHandle` objects, ordered by key.  This builds
+        every `FileHandle`, use `handle_for_key` to get a single one
+    path_index   : dict
+        Mapping from local file path to row index in the table
     base_path    : str
         Base file path for all files in this `FileArchive`
     """
     # Singleton instance
     _archive = None
 
+    # Minimum number of rows allocated for the column arrays
+    _min_capacity = 64
+
+    __slots__ = ('_table_file', '_table', '_nfiles', '_columns', '_handles',
+                 '_path_index', '_dirty', '_nrows_persisted', '_loaded',
+                 '_base_path', '_base_path_sep')
+
     def __init__(self, **kwargs):
         """C'tor
 
         Takes self.base_path from kwargs['base_path']
-        Reads kwargs['file_archive_table']
+        Takes the path of the table from kwargs['file_archive_table'],
+        the table itself is only read when it is first needed
         """
-        self._table_file = None
+        self._table_file = kwargs['file_archive_table']
+        self._loaded = False
         self._table = None
-        self._cache = OrderedDict()
+        self._nfiles = 0
+        self._columns = self._make_columns(0)
+        self._handles = []
+        self._path_index = {}
+        self._dirty = set()
+        self._nrows_persisted = 0
         self._base_path = kwargs['base_path']
-        self._read_table_file(kwargs['file_archive_table'])
+        self._base_path_sep = os.path.join(self._base_path, '')
 
     def __getitem__(self, key):
         """ Return the `FileHandle` whose linkname is key"""
-        return self._cache[key]
+        self._ensure_loaded()
+        return self._make_file_handle(self._path_index[key])
 
     @property
     def table_file(self):
@@ -582,12 +730,30 @@ class FileArchive(object):
     @property
     def table(self):
         """Return the persistent representation of this `FileArchive` """
+        self._ensure_loaded()
+        if self._table is None:
+            self._table = self._make_table()
         return self._table
 
     @property
     def cache(self):
-        """Return the transiet representation of this `FileArchive` """
-        return self._cache
+        """Return a read-only view of this `FileArchive`, keyed by local path """
+        return FileHandleView(self)
+
+    @property
+    def handles(self):
+        """Return the `FileHandle` objects in this `FileArchive`, ordered by key
+
+        This builds every `FileHandle` in the archive.
+        """
+        self._ensure_loaded()
+        return [self._make_file_handle(row) for row in range(self._nfiles)]
+
+    @property
+    def path_index(self):
+        """Return the mapping from local file path to table row index """
+        self._ensure_loaded()
+        return self._path_index
 
     @property
     def base_path(self):
@@ -596,38 +762,184 @@ class FileArchive(object):
 
     def _get_fullpath(self, filepath):
         """Return filepath with the base_path prefixed """
-        if filepath[0] == '/':
+        if filepath.startswith('/'):
             return filepath
-        return os.path.join(self._base_path, filepath)
+        return self._base_path_sep + filepath
 
     def _get_localpath(self, filepath):
         """Return the filepath with the base_path removed """
-        return filepath.replace(self._base_path, '')
+        if filepath.startswith(self._base_path_sep):
+            return filepath[len(self._base_path_sep):]
+        return filepath
+
+    @staticmethod
+    def _make_columns(capacity):
+        """Build and return a dict of empty column arrays"""
+        columns = {}
+        for colname in FILE_COLNAMES:
+            dtype = object if colname == 'path' else int
+            columns[colname] = np.zeros((capacity), dtype=dtype)
+        return columns
+
+    def _reserve(self, nfiles):
+        """Make sure the column arrays can hold at least nfiles rows
+
+        The arrays grow geometrically, so that registering files one at
+        a time only triggers a logarithmic number of copies.
+        """
+        capacity = len(self._columns['key'])
+        if nfiles <= capacity:
+            return
+        capacity = max(nfiles, 2 * capacity, self._min_capacity)
+        columns = self._make_columns(capacity)
+        for colname, data in self._columns.items():
+            columns[colname][0:self._nfiles] = data[0:self._nfiles]
+        self._columns = columns
+
+    def _fill_columns(self, table):
+        """Fill the column arrays from an `astropy.table.Table`"""
+        nfiles = len(table)
+        self._columns = self._make_columns(nfiles)
+        for colname in FILE_COLNAMES:
+            if colname == 'path':
+                self._columns[colname][:] = decode_column(table[colname]).tolist()
+            else:
+                self._columns[colname][:] = np.asarray(table[colname])
+        self._nfiles = nfiles
+        self._handles = [None] * nfiles
+        self._path_index = dict(zip(self._columns['path'].tolist(),
+                                    range(nfiles)))
 
-    def _fill_cache(self):
-        """Fill the cache from the `astropy.table.Table`"""
-        for irow in range(len(self._table)):
-            file_handle = self._make_file_handle(irow)
-            self._cache[file_handle.path] = file_handle
+    def _column_data(self, colname, rows):
+        """Return the values of one column for a slice or array of rows
+
+        Paths are encoded to the fixed length byte strings used on disk.
+        """
+        data = self._columns[colname][0:self._nfiles][rows]
+        if colname == 'path':
+            data = np.char.encode(data.astype(str), 'utf-8').astype('S256')
+        return data
+
+    def _make_table(self):
+        """Build and return an `astropy.table.Table` from the column arrays"""
+        data = [self._column_data(colname, slice(None))
+                for colname in FILE_COLNAMES]
+        return Table(data=data, names=FILE_COLNAMES)
+
+    def _use_hdf5(self):
+        """Return True if this `FileArchive` is persisted as HDF5
+
+        This raises an `ImportError` if the table file has an HDF5
+        extension but h5py is not available.
+        """
+        if os.path.splitext(self._table_file)[1] not in HDF5_EXTENSIONS:
+            return False
+        if not HAVE_H5PY:
+            raise ImportError("h5py is required to use the HDF5 file archive %s" %
+                              self._table_file)
+        return True
+
+    def _read_hdf5_table(self):
+        """Read the `astropy.table.Table` from the HDF5 file self._table_file"""
+        with h5py.File(self._table_file, 'r',
+                       rdcc_nbytes=HDF5_CACHE_NBYTES,
+                       rdcc_nslots=HDF5_CACHE_NSLOTS) as h5file:
+            group = h5file['FILE_ARCHIVE']
+            columns = [group[colname][...] for colname in FILE_COLNAMES]
+        return Table(data=columns, names=FILE_COLNAMES)
+
+    def _write_hdf5_table(self):
+        """Write the column arrays to the HDF5 file self._table_file
+
+        If the file already holds this archive, only the new rows
+        and the rows that have changed since the last write are written.
+        """
+        nrows = self._nfiles
+        nold = self._nrows_persisted
+        mode = 'a' if nold > 0 and os.path.exists(self._table_file) else 'w'
+        with h5py.File(self._table_file, mode,
+                       rdcc_nbytes=HDF5_CACHE_NBYTES,
+                       rdcc_nslots=HDF5_CACHE_NSLOTS) as h5file:
+            if mode == 'w':
+                group = h5file.create_group('FILE_ARCHIVE')
+                for colname in FILE_COLNAMES:
+                    group.create_dataset(colname,
+                                         data=self._column_data(colname, slice(None)),
+                                         maxshape=(None,), chunks=True)
+                return
+            group = h5file['FILE_ARCHIVE']
+            rows = np.array(sorted(row for row in self._dirty if row < nold),
+                            dtype=int)
+            for colname in FILE_COLNAMES:
+                dset = group[colname]
+                dset.resize((nrows,))
+                dset[nold:] = self._column_data(colname, slice(nold, None))
+                if rows.size and colname in FILE_MUTABLE_COLNAMES:
+                    dset[rows] = self._column_data(colname, rows)
+
+    def _ensure_loaded(self):
+        """Read the table file, if that has not been done yet"""
+        if not self._loaded:
+            self._read_table_file(self._table_file)
 
     def _read_table_file(self, table_file):
-        """Read an `astropy.table.Table` to set up the archive"""
+        """Read an `astropy.table.Table` to set up the archive
+
+        The table is not kept once the column arrays are filled.
+        """
         self._table_file = table_file
-        if os.path.exists(self._table_file):
-            self._table = Table.read(self._table_file)
+        if not os.path.exists(self._table_file):
+            table = FileHandle.make_table({})
+        elif self._use_hdf5():
+            table = self._read_hdf5_table()
         else:
-            self._table = FileHandle.make_table({})
-        self._fill_cache()
+            table = Table.read(self._table_file)
+        self._nrows_persisted = len(table)
+        self._fill_columns(table)
+        self._table = None
+        self._loaded = True
 
     def _make_file_handle(self, row_idx):
-        """Build and return a `FileHandle` object from an `astropy.table.row.Row` """
-        row = self._table[row_idx]
-        return FileHandle.create_from_row(row)
+        """Return the `FileHandle` object for a row of the column arrays
+
+        The `FileHandle` is built the first time it is requested.
+        """
+        file_handle = self._handles[row_idx]
+        if file_handle is None:
+            columns = self._columns
+            file_handle = FileHandle(key=int(columns['key'][row_idx]),
+                                     path=columns['path'][row_idx],
+                                     creator=int(columns['creator'][row_idx]),
+                                     timestamp=int(columns['timestamp'][row_idx]),
+                                     status=int(columns['status'][row_idx]),
+                                     flags=int(columns['flags'][row_idx]))
+            self._handles[row_idx] = file_handle
+        return file_handle
+
+    def _update_columns(self, file_handle):
+        """Copy the mutable values of a `FileHandle` to the column arrays"""
+        row_idx = file_handle.key - 1
+        for colname in FILE_MUTABLE_COLNAMES:
+            self._columns[colname][row_idx] = getattr(file_handle, colname)
+        self._dirty.add(row_idx)
+        self._table = None
+
+    def handle_for_key(self, key):
+        """Get the `FileHandle` object with a particular key
+
+        If there is no such file, this raises a `KeyError`
+        """
+        self._ensure_loaded()
+        if key < 1 or key > self._nfiles:
+            raise KeyError("No file with key %i in archive" % key)
+        # The key of each file is its row index + 1
+        return self._make_file_handle(key - 1)
 
     def get_handle(self, filepath):
         """Get the `FileHandle` object associated to a particular file """
+        self._ensure_loaded()
         localpath = self._get_localpath(filepath)
-        return self._cache[localpath]
+        return self._make_file_handle(self._path_index[localpath])
 
     def register_file(self, filepath, creator, status=FileStatus.no_file, flags=FileFlags.no_flags):
         """Register a file in the archive.
@@ -648,33 +960,82 @@ class FileArchive(object):
 
         Returns `FileHandle`
         """
-        # check to see if the file already exists
-        try:
-            file_handle = self.get_handle(filepath)
-            raise KeyError("File %s already exists in archive" % filepath)
-        except KeyError:
-            pass
-        localpath = self._get_localpath(filepath)
+        return self.register_files([filepath], creator, status, flags)[0]
+
+    def register_files(self, filepaths, creator, status=FileStatus.no_file,
+                       flags=FileFlags.no_flags):
+        """Register a set of files in the archive.
+
+        This is equivalent to calling `register_file` for each file, but
+        the modification times of existing files are harvested together,
+        with one directory listing for directories in which many files
+        are registered (see `get_file_timestamps`).
+
+        If any of the files already exists, this raises a `KeyError`
+        and none of the files are registered.  If flags is a list whose
+        length does not match filepaths, this raises a `ValueError`.
+
+        Parameters
+        ----------
+
+        filepaths : list
+            The paths to the files
+        creatror : int
+            A unique key for the job that created these files
+        status   : `FileStatus`
+            Enumeration giving current status of the files
+        flags   : `FileFlags` or list
+            Enumeration giving flags set on the files, either one value
+            for all the files or one value per file
+
+        Returns list of `FileHandle`
+        """
+        self._ensure_loaded()
+        if np.isscalar(flags):
+            flags = [flags] * len(filepaths)
+        elif len(flags) != len(filepaths):
+            raise ValueError("Got %i flags for %i files" % (len(flags), len(filepaths)))
+        localpaths = [self._get_localpath(filepath) for filepath in filepaths]
+        new_paths = set()
+        for filepath, localpath in zip(filepaths, localpaths):
+            if localpath in self._path_index or localpath in new_paths:
+                raise KeyError("File %s already exists in archive" % filepath)
+            new_paths.add(localpath)
+        fullpaths = [self._get_fullpath(filepath) for filepath in filepaths]
         if status == FileStatus.exists:
-            # Make sure the file really exists
-            fullpath = self._get_fullpath(filepath)
-            if not os.path.exists(fullpath):
-                print("register_file called on called on mising file %s" % fullpath)
-                status = FileStatus.missing
-                timestamp = 0
-            else:
-                timestamp = int(os.stat(fullpath).st_mtime)
-        else:
+            timestamps = get_file_timestamps(fullpaths)
+        self._reserve(self._nfiles + len(filepaths))
+        ret_list = []
+        for fullpath, localpath, file_flags in zip(fullpaths, localpaths, flags):
+            file_status = status
             timestamp = 0
-        key = len(self._table) + 1
+            if status == FileStatus.exists:
+                # Make sure the file really exists
+                timestamp = timestamps.get(fullpath)
+                if timestamp is None:
+                    print("register_file called on missing file %s" % fullpath)
+                    file_status = FileStatus.missing
+                    timestamp = 0
+            ret_list.append(self._add_file(localpath, creator, timestamp,
+                                           file_status, file_flags))
+        return ret_list
+
+    def _add_file(self, localpath, creator, timestamp, status, flags):
+        """Add a new row to the column arrays and return its `FileHandle`"""
+        row_idx = self._nfiles
         file_handle = FileHandle(path=localpath,
-                                 key=key,
+                                 key=row_idx + 1,
                                  creator=creator,
                                  timestamp=timestamp,
                                  status=status,
                                  flags=flags)
-        file_handle.append_to_table(self._table)
-        self._cache[localpath] = file_handle
+        self._reserve(row_idx + 1)
+        for colname in FILE_COLNAMES:
+            self._columns[colname][row_idx] = getattr(file_handle, colname)
+        self._nfiles += 1
+        self._handles.append(file_handle)
+        self._path_index[localpath] = row_idx
+        self._table = None
         return file_handle
 
     def update_file(self, filepath, creator, status):
@@ -697,7 +1058,7 @@ class FileArchive(object):
         file_handle = self.get_handle(filepath)
         if status in [FileStatus.exists, FileStatus.superseded]:
             # Make sure the file really exists
-            fullpath = file_handle.fullpath
+            fullpath = self._get_fullpath(filepath)
             if not os.path.exists(fullpath):
                 raise ValueError("File %s does not exist" % fullpath)
             timestamp = int(os.stat(fullpath).st_mtime)
@@ -706,7 +1067,7 @@ class FileArchive(object):
         file_handle.creator = creator
         file_handle.timestamp = timestamp
         file_handle.status = status
-        file_handle.update_table_row(self._table, file_handle.key - 1)
+        self._update_columns(file_handle)
         return file_handle
 
     def get_file_ids(self, file_list, creator=None,
@@ -725,23 +1086,31 @@ class FileArchive(object):
         file_dict : `FileDict`
             Mask giving flags set on this file
 
-        Returns list of integers
+        Returns `numpy.array` of integer file keys
         """
-        ret_list = []
-        for fname in file_list:
+        self._ensure_loaded()
+        path_index = self._path_index
+        localpaths = [self._get_localpath(fname) for fname in file_list]
+        # Split off the files that are not yet in the archive,
+        # and register them all at once
+        missing = []
+        new_paths = set()
+        for fname, localpath in zip(file_list, localpaths):
+            if localpath not in path_index and localpath not in new_paths:
+                new_paths.add(localpath)
+                missing.append(fname)
+        if missing:
+            if creator is None:
+                creator = -1
+                # raise KeyError("Can not register a file %s without a creator"%fname)
             if file_dict is None:
                 flags = FileFlags.no_flags
             else:
-                flags = file_dict.file_dict[fname]
-            try:
-                fhandle = self.get_handle(fname)
-            except KeyError:
-                if creator is None:
-                    creator = -1
-                    # raise KeyError("Can not register a file %s without a creator"%fname)
-                fhandle = self.register_file(fname, creator, status, flags)
-            ret_list.append(fhandle.key)
-        return ret_list
+                flags = [file_dict.file_dict[fname] for fname in missing]
+            self.register_files(missing, creator, status, flags)
+        # The key of each file is its row index + 1
+        return np.fromiter((path_index[localpath] for localpath in localpaths),
+                           dtype=np.int64, count=len(localpaths)) + 1
 
     def get_file_paths(self, id_list):
         """Get a list of file paths based of a set of ids
@@ -749,45 +1118,58 @@ class FileArchive(object):
         Parameters
         ----------
 
-        id_list : list
+        id_list : list or `numpy.array`
             List of integer file keys
 
         Returns list of file paths
         """
         if id_list is None:
             return []
+        self._ensure_loaded()
         try:
-            path_array = self._table[id_list - 1]['path']
+            path_array = self._columns['path'][0:self._nfiles][np.asarray(id_list, dtype=int) - 1]
         except IndexError:
-            print("IndexError ", len(self._table), id_list)
-            path_array = []
-        return [path for path in path_array]
+            print("IndexError ", self._nfiles, id_list)
+            return []
+        return path_array.tolist()
 
     def write_table_file(self, table_file=None):
         """Write the table to self._table_file"""
-        if self._table is None:
-            raise RuntimeError("No table to write")
-        if table_file is not None:
+        self._ensure_loaded()
+        if table_file is not None and table_file != self._table_file:
             self._table_file = table_file
+            self._nrows_persisted = 0
         if self._table_file is None:
             raise RuntimeError("No output file specified for table")
-        write_tables_to_fits(self._table_file, [self._table], clobber=True,
-                             namelist=['FILE_ARCHIVE'])
+        if self._use_hdf5():
+            self._write_hdf5_table()
+        else:
+            write_tables_to_fits(self._table_file, [self.table], clobber=True,
+                                 namelist=['FILE_ARCHIVE'])
+        self._nrows_persisted = self._nfiles
+        self._dirty.clear()
+
+    def flush(self):
+        """Write all the changes since the last write to self._table_file"""
+        self.write_table_file()
 
     def update_file_status(self):
         """Update the status of all the files in the archive"""
-        nfiles = len(self.cache.keys())
+        self._ensure_loaded()
+        nfiles = self._nfiles
         status_vect = np.zeros((6), int)
         sys.stdout.write("Updating status of %i files: " % nfiles)
         sys.stdout.flush()
-        for i, key in enumerate(self.cache.keys()):
+        for i in range(nfiles):
             if i % 200 == 0:
                 sys.stdout.write('.')
                 sys.stdout.flush()
-            fhandle = self.cache[key]
+            fhandle = self._make_file_handle(i)
             fhandle.check_status(self._base_path)
-            fhandle.update_table_row(self._table, fhandle.key - 1)
+            self._columns['status'][i] = fhandle.status
             status_vect[fhandle.status] += 1
+        self._dirty.update(range(nfiles))
+        self._table = None
 
         sys.stdout.write("!\n")
         sys.stdout.flush()
@@ -362,12 +362,12 @@ class Link(object):
         """Internal function to update the dictionaries
         keeping track of input and output files
         """
-        self.files.file_dict.clear()
+        self.files.clear()
         self.files.latch_file_info(self.args)
 
     def _update_sub_file_dict(self, sub_files):
         """Update a file dict with information from self"""
-        sub_files.file_dict.clear()
+        sub_files.clear()
         for job_details in self.jobs.values():
             if job_details.file_dict is not None:
                 sub_files.update(job_details.file_dict)
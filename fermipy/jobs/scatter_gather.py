@@ -139,8 +139,8 @@ class ScatterGather(Link):
         """Internal function to update the dictionaries
         keeping track of input and output files
         """
-        self.files.file_dict.clear()
-        self.sub_files.file_dict.clear()
+        self.files.clear()
+        self.sub_files.clear()
         self.files.latch_file_info(self.args)
         self._scatter_link._update_sub_file_dict(self.sub_files)
 
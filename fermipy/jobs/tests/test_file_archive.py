@@ -3,7 +3,13 @@ from __future__ import absolute_import, division, print_function
 
 import os
 
-from fermipy.jobs.file_archive import FileStatus, FileHandle, FileArchive
+import numpy as np
+import pytest
+from astropy.table import Table
+
+from fermipy.tests.utils import requires_dependency
+from fermipy.jobs.file_archive import FileStatus, FileFlags, FileDict, FileHandle, FileArchive
+from fermipy.jobs.file_archive import get_unique_match
 
 def assert_str_eq(str1, str2):
     try:
@@ -32,6 +38,73 @@ def test_file_handle():
     assert file_handle.timestamp == file_handle2.timestamp
     assert file_handle.status == file_handle2.status
 
+    file_dict[1] = FileHandle(path="test2", key=1, creator=3)
+    file_dict3 = FileHandle.make_dict(FileHandle.make_table(file_dict))
+    assert sorted(file_dict3.keys()) == [0, 1]
+    assert file_dict3[1].path == "test2"
+    assert file_dict3[1].creator == 3
+
+    file_handle3 = FileHandle.create_from_row(table[0])
+    assert file_handle3.path == "test"
+    assert file_handle3.key == 0
+
+
+def test_get_unique_match():
+    """ Test finding the unique row matching a value """
+
+    table = Table(data=[np.array([b'test_a', b'test_b', b'test_b']),
+                        np.array(['test_a', 'test_b', 'test_c']),
+                        np.array([1, 2, 3])],
+                  names=['bytes', 'str', 'int'])
+    assert table['bytes'].dtype.kind == 'S'
+    assert get_unique_match(table, 'bytes', 'test_a') == 0
+    assert get_unique_match(table, 'str', 'test_c') == 2
+    assert get_unique_match(table, 'int', 2) == 1
+    with pytest.raises(KeyError):
+        get_unique_match(table, 'bytes', 'test_b')
+    with pytest.raises(KeyError):
+        get_unique_match(table, 'bytes', 'test_d')
+
+
+def test_file_dict():
+    """ Test the file selections of a `FileDict` """
+
+    file_dict = FileDict()
+    file_dict.update({'in.fits': FileFlags.input_mask,
+                      'out.fits': FileFlags.output_mask,
+                      'tmp.fits': FileFlags.output_mask | FileFlags.rm_mask,
+                      'int.fits': FileFlags.output_mask | FileFlags.internal_mask})
+    file_dict.update({'int.fits': FileFlags.input_mask})
+
+    assert file_dict.input_files == ['in.fits', 'int.fits']
+    assert file_dict.output_files == ['out.fits', 'tmp.fits', 'int.fits']
+    assert file_dict.chain_input_files == ['in.fits']
+    assert file_dict.chain_output_files == ['out.fits']
+    assert file_dict.temp_files == ['tmp.fits']
+    assert file_dict.internal_files == ['int.fits']
+    assert file_dict.gzip_files == []
+
+    file_dict.file_dict['in.fits'] = FileFlags.gz_mask
+    assert file_dict.gzip_files == ['in.fits']
+    file_dict.file_dict['wide.fits'] = 256 | FileFlags.input_mask
+    assert file_dict.input_files == ['int.fits', 'wide.fits']
+
+    file_dict.clear()
+    assert file_dict.input_files == []
+
+    file_dict = FileDict(file_args={'infile': FileFlags.input_mask,
+                                    'outfile': FileFlags.output_mask,
+                                    'args': FileFlags.input_mask})
+    file_dict.latch_file_info({'infile': 'in.fits.gz',
+                               'outfile': None,
+                               'args': 'a.fits b.fits'})
+    assert file_dict.input_files == ['in.fits', 'a.fits', 'b.fits']
+    assert file_dict.output_files == []
+
+    file_dict.file_args['outfile'] = FileFlags.output_mask | FileFlags.rm_mask
+    file_dict.latch_file_info({'outfile': 'tmp.fits'})
+    assert file_dict.temp_files == ['tmp.fits']
+
 
 def test_file_archive():
     """ Test that we can build a `FileArchive` """
@@ -49,6 +122,253 @@ def test_file_archive():
     assert file_handle.key == file_handle2.key
 
 
+def test_file_archive_path_index():
+    """ Test the path to row index lookup of a `FileArchive` """
+
+    file_archive = FileArchive(file_archive_table='archive_files.fits',
+                               base_path=os.path.abspath('.'))
+    for fname in ['test_a', 'test_b', 'test_c']:
+        file_archive.register_file(filepath=fname, creator=0)
+
+    assert file_archive.path_index['test_b'] == 1
+    assert file_archive.get_handle('test_c').key == 3
+    assert file_archive.get_file_paths([3, 1]) == ['test_c', 'test_a']
+    assert file_archive.get_file_ids(['test_b', 'test_d', 'test_d']).tolist() == [2, 4, 4]
+    with pytest.raises(KeyError):
+        file_archive.register_file(filepath='test_a', creator=0)
+
+
+def test_file_archive_get_file_ids(tmpdir, monkeypatch):
+    """ Test registering existing files through `FileArchive.get_file_ids` """
+
+    file_archive = FileArchive(file_archive_table=str(tmpdir.join('archive_files.fits')),
+                               base_path=str(tmpdir))
+    for i in range(20):
+        tmpdir.join('test_%i' % i).write('')
+    file_dict = FileDict()
+    file_dict.update({'test_0': FileFlags.output_mask,
+                      'test_missing': FileFlags.output_mask | FileFlags.rm_mask})
+
+    def fail_scandir(dirname):
+        pytest.fail("listed %s to register two files" % dirname)
+    monkeypatch.setattr(os, 'scandir', fail_scandir, raising=False)
+
+    file_ids = file_archive.get_file_ids(['test_0', 'test_missing'], creator=3,
+                                         status=FileStatus.exists,
+                                         file_dict=file_dict)
+    assert file_ids.tolist() == [1, 2]
+    file_handle = file_archive.get_handle('test_0')
+    assert file_handle.status == FileStatus.exists
+    assert file_handle.timestamp == int(os.stat(str(tmpdir.join('test_0'))).st_mtime)
+    assert file_handle.flags == FileFlags.output_mask
+    file_handle = file_archive.get_handle('test_missing')
+    assert file_handle.status == FileStatus.missing
+    assert file_handle.creator == 3
+    assert file_handle.flags == FileFlags.output_mask | FileFlags.rm_mask
+
+
+def test_file_archive_cache(tmpdir):
+    """ Test the read-only cache view of a `FileArchive` """
+
+    file_archive = FileArchive(file_archive_table=str(tmpdir.join('archive_files.fits')),
+                               base_path=str(tmpdir))
+    cache = file_archive.cache
+    file_archive.register_file(filepath='test_a', creator=1,
+                               status=FileStatus.expected)
+    file_archive.register_file(filepath='test_b', creator=1,
+                               status=FileStatus.expected)
+    assert len(cache) == 2
+    assert 'test_a' in cache
+    assert 'test_c' not in cache
+    assert sorted(cache) == ['test_a', 'test_b']
+    assert cache['test_b'] is file_archive.get_handle('test_b')
+    assert file_archive.handle_for_key(2) is cache['test_b']
+    assert [fhandle.key for fhandle in file_archive.handles] == [1, 2]
+    with pytest.raises(KeyError):
+        file_archive.handle_for_key(3)
+    with pytest.raises(KeyError):
+        file_archive.handle_for_key(0)
+    with pytest.raises(KeyError):
+        cache['test_c']
+    with pytest.raises(TypeError):
+        cache['test_c'] = cache['test_a']
+
+
+def test_file_archive_local_paths():
+    """ Test that the base path is only removed as a leading directory """
+
+    file_archive = FileArchive(file_archive_table='archive_files.fits',
+                               base_path='/data/run')
+    file_handle = file_archive.register_file(filepath='/data/run/x.fits', creator=0)
+    assert file_handle.path == 'x.fits'
+    assert file_archive.get_handle('x.fits').key == file_handle.key
+    file_handle2 = file_archive.register_file(filepath='/data/run2/x.fits', creator=0)
+    assert file_handle2.path == '/data/run2/x.fits'
+    assert file_archive.get_file_paths([1, 2]) == ['x.fits', '/data/run2/x.fits']
+
+
+@pytest.mark.parametrize('extension', ['.fits', '.ecsv'])
+def test_file_archive_write(tmpdir, extension):
+    """ Test that a `FileArchive` survives a write / read cycle """
+
+    table_file = str(tmpdir.join('archive_files' + extension))
+    file_archive = FileArchive(file_archive_table=table_file,
+                               base_path=str(tmpdir))
+    for fname in ['test_a', 'test_b', 'test_c']:
+        file_archive.register_file(filepath=fname, creator=1,
+                                   status=FileStatus.expected)
+    file_archive.update_file(filepath='test_b', creator=2,
+                             status=FileStatus.missing)
+    assert len(file_archive.table) == 3
+    file_archive.table.write(table_file)
+
+    file_archive2 = FileArchive(file_archive_table=table_file,
+                                base_path=str(tmpdir))
+    assert len(file_archive2.table) == 3
+    file_handle = file_archive2.get_handle('test_b')
+    assert file_handle.key == 2
+    assert file_handle.creator == 2
+    assert file_handle.status == FileStatus.missing
+
+
+def test_file_archive_register_files(tmpdir):
+    """ Test registering a set of existing files in a `FileArchive` """
+
+    file_archive = FileArchive(file_archive_table=str(tmpdir.join('archive_files.fits')),
+                               base_path=str(tmpdir))
+    filepaths = []
+    for fname in ['test_a', 'test_b']:
+        tmpdir.join(fname).write('')
+        filepaths.append(str(tmpdir.join(fname)))
+    filepaths.append(str(tmpdir.join('test_c')))
+
+    file_handles = file_archive.register_files(filepaths, creator=1,
+                                               status=FileStatus.exists)
+    assert [fhandle.key for fhandle in file_handles] == [1, 2, 3]
+    assert file_handles[0].status == FileStatus.exists
+    assert file_handles[0].timestamp == int(os.stat(filepaths[0]).st_mtime)
+    assert file_handles[2].status == FileStatus.missing
+    with pytest.raises(KeyError):
+        file_archive.register_files(filepaths[0:1], creator=1)
+    with pytest.raises(ValueError):
+        file_archive.register_files([str(tmpdir.join('test_d')), str(tmpdir.join('test_e'))],
+                                    creator=1, flags=[FileFlags.input_mask])
+    assert len(file_archive.path_index) == 3
+
+    file_handle = file_archive.update_file(filepaths[1], creator=2,
+                                           status=FileStatus.superseded)
+    assert file_handle.timestamp == int(os.stat(filepaths[1]).st_mtime)
+
+
+def test_get_file_timestamps(tmpdir, monkeypatch):
+    """ Test that listing a directory and per-file stats agree """
+
+    from fermipy.jobs import file_archive as file_archive_module
+    fullpaths = []
+    for i in range(20):
+        tmpdir.join('test_%i' % i).write('')
+        fullpaths.append(str(tmpdir.join('test_%i' % i)))
+    fullpaths.append(str(tmpdir.join('test_missing')))
+    expected = {fullpath: int(os.stat(fullpath).st_mtime)
+                for fullpath in fullpaths[0:-1]}
+
+    scanned = []
+    scandir = os.scandir
+
+    def counting_scandir(dirname):
+        scanned.append(dirname)
+        return scandir(dirname)
+    monkeypatch.setattr(os, 'scandir', counting_scandir)
+
+    # A single file is checked with os.stat, not by listing its directory
+    assert file_archive_module.get_file_timestamps(fullpaths[0:1]) == \
+        {fullpaths[0]: expected[fullpaths[0]]}
+    assert scanned == []
+
+    monkeypatch.setattr(file_archive_module, 'SCANDIR_MIN_FRACTION', 0.)
+    assert file_archive_module.get_file_timestamps(fullpaths) == expected
+    assert scanned == [str(tmpdir)]
+
+    # Python 2 has no os.scandir
+    monkeypatch.delattr(os, 'scandir')
+    assert file_archive_module.get_file_timestamps(fullpaths) == expected
+
+
+@requires_dependency('h5py')
+def test_file_archive_hdf5(tmpdir):
+    """ Test that a `FileArchive` can be persisted as HDF5 """
+
+    table_file = str(tmpdir.join('archive_files.hdf5'))
+    file_archive = FileArchive(file_archive_table=table_file,
+                               base_path=str(tmpdir))
+    file_archive.write_table_file()
+    for fname in ['test_a', 'test_b']:
+        file_archive.register_file(filepath=fname, creator=1)
+    file_archive.write_table_file()
+
+    file_archive2 = FileArchive(file_archive_table=table_file,
+                                base_path=str(tmpdir))
+    file_archive2.register_file(filepath='test_c', creator=1)
+    file_archive2.update_file(filepath='test_a', creator=2,
+                              status=FileStatus.missing)
+    file_archive2.flush()
+
+    file_archive3 = FileArchive(file_archive_table=table_file,
+                                base_path=str(tmpdir))
+    assert len(file_archive3.table) == 3
+    assert file_archive3.get_handle('test_c').key == 3
+    assert file_archive3.get_handle('test_a').creator == 2
+    assert file_archive3.get_handle('test_a').status == FileStatus.missing
+
+
+@requires_dependency('h5py')
+def test_file_archive_lazy_read(tmpdir, monkeypatch):
+    """ Test that a `FileArchive` is only read when its contents are needed """
+
+    table_file = str(tmpdir.join('archive_files.hdf5'))
+    file_archive = FileArchive(file_archive_table=table_file,
+                               base_path=str(tmpdir))
+    for fname in ['test_a', 'test_b']:
+        file_archive.register_file(filepath=fname, creator=1)
+    file_archive.write_table_file()
+
+    read_files = []
+    read_table_file = FileArchive._read_table_file
+
+    def counting_read_table_file(self, table_file):
+        read_files.append(table_file)
+        read_table_file(self, table_file)
+    monkeypatch.setattr(FileArchive, '_read_table_file', counting_read_table_file)
+
+    file_archive2 = FileArchive(file_archive_table=table_file,
+                                base_path=str(tmpdir))
+    assert read_files == []
+    assert file_archive2.get_handle('test_b').key == 2
+    assert read_files == [table_file]
+    assert len(file_archive2.table) == 2
+    assert read_files == [table_file]
+
+    # A write before any access must keep the rows already on disk
+    file_archive3 = FileArchive(file_archive_table=table_file,
+                                base_path=str(tmpdir))
+    file_archive3.write_table_file()
+    file_archive4 = FileArchive(file_archive_table=table_file,
+                                base_path=str(tmpdir))
+    assert len(file_archive4.table) == 2
+    assert file_archive4.get_handle('test_a').key == 1
+
+
+def test_file_archive_hdf5_missing(tmpdir, monkeypatch):
+    """ Test that an HDF5 `FileArchive` requires h5py """
+
+    from fermipy.jobs import file_archive as file_archive_module
+    monkeypatch.setattr(file_archive_module, 'HAVE_H5PY', False)
+    file_archive = FileArchive(file_archive_table=str(tmpdir.join('archive_files.h5')),
+                               base_path=str(tmpdir))
+    with pytest.raises(ImportError):
+        file_archive.write_table_file()
+
+
 if __name__ == '__main__':
     test_file_handle()
     test_file_archive()